@@ -1,186 +1,329 @@
-from datetime import time
-import pydub
-import simpleaudio
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import mmap
+import numpy as np
+import os
+import sounddevice as sd
+import soundfile as sf
+import struct
+import tempfile
 import time
 import toml
 import random
+import threading
 
 
 DEBUG = False
+CACHE_DIR = './cache'
+# Part of every cache key; bump it whenever the mixdown output changes
+# so stale files are ignored rather than replayed.
+MIX_VERSION = 3
+
+# Every sample is converted to this format when it is loaded, so a single
+# output stream can play all of them.
+STREAM_FRAME_RATE = 48000
+STREAM_CHANNELS = 2
+
+
+def conformed(samples, frame_rate):
+    if samples.shape[1] == 1:
+        samples = np.repeat(samples, STREAM_CHANNELS, axis=1)
+    else:
+        samples = samples[:, :STREAM_CHANNELS]
+
+    if frame_rate != STREAM_FRAME_RATE:
+        length = round(len(samples) * STREAM_FRAME_RATE / frame_rate)
+        positions = np.arange(length) * (frame_rate / STREAM_FRAME_RATE)
+        frames = np.arange(len(samples))
+        samples = np.stack([
+            np.interp(positions, frames, samples[:, channel])
+            for channel in range(STREAM_CHANNELS)
+        ], axis=1).astype(np.int16)
+
+    return samples
+
+
+def map_wav(filename):
+    # Return the data of a 16-bit PCM WAV that is already in the stream
+    # format as an array backed by a read-only memory map of the file,
+    # so it is never copied onto the heap. Returns None for any other
+    # file, which then has to be decoded and converted.
+    with open(filename, 'rb') as wav_file:
+        # mmap can't map an empty file, and anything shorter than the
+        # RIFF header isn't a WAV we can map anyway.
+        if os.fstat(wav_file.fileno()).st_size < 12:
+            return None
+        mm = mmap.mmap(wav_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    riff, _, wave_id = struct.unpack_from('<4sI4s', mm, 0)
+    if riff != b'RIFF' or wave_id != b'WAVE':
+        return None
+
+    wav_format = None
+    offset = 12
+    while offset + 8 <= len(mm):
+        chunk_id, chunk_size = struct.unpack_from('<4sI', mm, offset)
+        offset += 8
+        if chunk_id == b'fmt ':
+            audio_format, channels, frame_rate, _, _, bits = struct.unpack_from('<HHIIHH', mm, offset)
+            wav_format = (audio_format, channels, frame_rate, bits)
+        elif chunk_id == b'data':
+            if wav_format != (1, STREAM_CHANNELS, STREAM_FRAME_RATE, 16):
+                return None
+            frames = min(chunk_size, len(mm) - offset) // (2 * STREAM_CHANNELS)
+            samples = np.frombuffer(mm, dtype='<i2', count=frames * STREAM_CHANNELS, offset=offset)
+            return samples.reshape(-1, STREAM_CHANNELS)
+        offset += chunk_size + (chunk_size & 1)
+
+    return None
+
+
+def read_wav(filename):
+    samples, frame_rate = sf.read(filename, dtype='int16', always_2d=True)
+    return conformed(samples, frame_rate)
+
+
+# Samples, keyed by filename. Many sounds share the same files (e.g.
+# every major chord's identity ends in "maj").
+_SAMPLE_CACHE = {}
+
+
+def load_sample(filename):
+    # Only the bundled samples come through here, so the number of
+    # mappings (each of which keeps a file descriptor open) is bounded
+    # by the size of ./samples.
+    if filename not in _SAMPLE_CACHE:
+        samples = map_wav(filename)
+        if samples is None:
+            samples = read_wav(filename)
+        _SAMPLE_CACHE[filename] = samples
+    return _SAMPLE_CACHE[filename]
+
+
+def overlay(placed, attenuation=1):
+    # Sum (start_frame, samples) pairs in place into one int32
+    # accumulator, divide by the attenuation and narrow back to int16.
+    # A buffer that would still overflow is scaled down as a whole
+    # rather than clipped.
+    total_frames = max(start + len(samples) for start, samples in placed)
+    mixed = np.zeros((total_frames, STREAM_CHANNELS), dtype=np.int32)
+    for start, samples in placed:
+        mixed[start:start + len(samples)] += samples
+    if attenuation != 1:
+        mixed //= attenuation
+
+    peak = int(np.abs(mixed).max())
+    if peak > 32767:
+        mixed = (mixed * (32767 / peak)).astype(np.int32)
+    return mixed.astype(np.int16)
+
+
+class Mixer:
+    def __init__(self):
+        self.voices = []
+        self.lock = threading.Lock()
+        self.stream = sd.OutputStream(
+            samplerate=STREAM_FRAME_RATE,
+            channels=STREAM_CHANNELS,
+            dtype='int16',
+            callback=self.callback,
+        )
+        self.stream.start()
+
+    def play(self, samples):
+        with self.lock:
+            self.voices.append((samples, 0))
+
+    def callback(self, outdata, frames, time_info, status):
+        # Sounds overlap (a note rings on under the next one), so sum
+        # every voice that is still playing into the output block.
+        mixed = np.zeros((frames, STREAM_CHANNELS), dtype=np.int32)
+        with self.lock:
+            voices = []
+            for samples, position in self.voices:
+                chunk = samples[position:position + frames]
+                mixed[:len(chunk)] += chunk
+                if position + frames < len(samples):
+                    voices.append((samples, position + frames))
+            self.voices = voices
+
+        outdata[:] = np.clip(mixed, -32768, 32767, out=mixed)
 
 
 class Sound:
+    __slots__ = ('filenames', 'sequential', '_samples')
+
     def __init__(self, filenames, sequential=False):
         if isinstance(filenames, str):
             self.filenames = [self.cleaned_filename(filenames)]
         else:
             self.filenames = [self.cleaned_filename(filename) for filename in filenames]
         self.sequential = sequential
+        self._samples = None
 
-    def play(self):
+    @property
+    def samples(self):
+        # Loaded on first use, so only programs that actually get played
+        # ever read their samples.
+        if self._samples is None:
+            self._samples = self.load_samples()
+        return self._samples
+
+    def load_samples(self):
         if len(self.filenames) == 1:
-            wav_obj = simpleaudio.WaveObject.from_wave_file(self.filenames[0])
-        else:
-            audio_segments = []
-            for filename in self.filenames:
-                audio_segment = pydub.AudioSegment.from_wav(filename)
-                # When overlaying audio segments, reduce the volume to
-                # avoid clipping.
-                if not self.sequential:
-                    audio_segment = self.attenuated(audio_segment)
-                audio_segments.append(audio_segment)
-
-            combined_audio = None
-
-            for audio_segment in audio_segments:
-                if combined_audio is None:
-                    combined_audio = audio_segment
-                else:
-                    if self.sequential:
-                        combined_audio = combined_audio + audio_segment
-                    else:
-                        combined_audio = combined_audio.overlay(audio_segment)
-
-            wav_obj = simpleaudio.WaveObject(
-                combined_audio.raw_data,
-                combined_audio.channels,
-                combined_audio.sample_width,
-                combined_audio.frame_rate,
-            )
-
-        wav_obj.play()
-
-    def attenuated(self, audio_segment):
-        return audio_segment - 6
+            return load_sample(self.filenames[0])
+
+        # Mixdowns only depend on their source files, so keep them on
+        # disk and read them back on later runs. They are read into
+        # memory rather than mapped: each mapping holds a file descriptor
+        # open, and there is one mixdown per chord and identity.
+        cache_filename = self.cache_filename()
+        if os.path.exists(cache_filename):
+            samples, _ = sf.read(cache_filename, dtype='int16', always_2d=True)
+            return samples
+
+        samples = self.mixed_samples()
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_file = tempfile.NamedTemporaryFile(dir=CACHE_DIR, suffix='.tmp', delete=False)
+        try:
+            with tmp_file:
+                sf.write(tmp_file, samples, STREAM_FRAME_RATE, format='WAV', subtype='PCM_16')
+            os.replace(tmp_file.name, cache_filename)
+        except BaseException:
+            os.unlink(tmp_file.name)
+            raise
+        return samples
+
+    def mixed_samples(self):
+        arrays = [load_sample(filename) for filename in self.filenames]
+
+        if self.sequential:
+            return np.concatenate(arrays)
+
+        # Halve each note (about -6 dB) so a chord keeps its headroom;
+        # a single note already peaks above a third of full scale.
+        return overlay([(0, samples) for samples in arrays], attenuation=2)
+
+    def cache_filename(self):
+        key = hashlib.blake2b(
+            '\0'.join(self.filenames).encode() + struct.pack('<?I', self.sequential, MIX_VERSION),
+            digest_size=8,
+        ).hexdigest()
+        return os.path.join(CACHE_DIR, f'{key}.wav')
 
     def cleaned_filename(self, filename):
-        return filename.replace('#', 'sh').replace('b', 'flat')
-
+        # Spell out the accidental of a leading pitch name ("C#3.wav",
+        # "Bb.wav") without touching the rest of the path.
+        directory, basename = os.path.split(filename)
+        basename = basename.replace('#', 'sh')
+        if basename[:1] in 'ABCDEFG' and basename[1:2] == 'b':
+            basename = basename[0] + 'flat' + basename[2:]
+        return os.path.join(directory, basename)
 
-class ProgramStep:
-    def __init__(self, duration):
-        self.is_running = False
-        self.start_time = None
-        self.duration = duration
-
-    def start(self):
-        if DEBUG:
-            print(f'{self}::start')
-        self.is_running = True
-        self.start_time = time.time()
-
-    @property
-    def elapsed_ms(self):
-        if not self.start_time:
-            return None
 
-        return int((time.time() - self.start_time) * 1000)
+def sleep_until(deadline_ns):
+    time.sleep(max(0, deadline_ns - time.monotonic_ns()) / 1e9)
 
-    def stop(self):
-        if DEBUG:
-            print(f'{self}::stop [{self.elapsed_ms} ms]')
-        self.is_running = False
-        self.start_time = None
 
-    @property
-    def is_complete(self):
-        return not self.is_running
+class ProgramStep:
+    __slots__ = ('duration', 'duration_ns')
 
-    def step(self):
-        if self.elapsed_ms > self.duration:
-            self.stop()
+    def __init__(self, duration):
+        self.duration = duration
+        self.duration_ns = duration * 1_000_000
 
 
 class ProgramStep_PlayNote(ProgramStep):
+    __slots__ = ('note', 'sound')
+
     def __init__(self, note, duration):
         super().__init__(duration)
         self.note = note
-
-    def start(self):
-        super().start()
-        self.note.sound.play()
+        self.sound = note.sound
 
     def __repr__(self):
         return f'ProgramStep_PlayNote: {self.note.name} ({self.duration} ms)'
 
 
 class ProgramStep_PlayChord(ProgramStep):
+    __slots__ = ('chord', 'sound')
+
     def __init__(self, chord, duration):
         super().__init__(duration)
         self.chord = chord
-
-    def start(self):
-        super().start()
-        self.chord.sound.play()
+        self.sound = chord.sound
 
     def __repr__(self):
         return f'ProgramStep_PlayChord: {self.chord.name} ({self.duration} ms)'
 
 
 class ProgramStep_PlayIdentity(ProgramStep):
+    __slots__ = ('identity', 'sound')
+
     def __init__(self, identity, duration):
         super().__init__(duration)
         self.identity = identity
-
-    def start(self):
-        super().start()
-        self.identity.sound.play()
+        self.sound = identity.sound
 
     def __repr__(self):
         return f'ProgramStep_PlayIdentity: {self.identity.name} ({self.duration} ms)'
 
 
 class Program:
+    __slots__ = ('name', 'steps', 'events', 'duration_ns')
+
     def __init__(self, name, steps):
         self.name = name
         self.steps = steps
-        self.is_running = False
-        self.current_step_idx = -1
-        self.current_step = None
-
-    def start(self):
+        self.events, self.duration_ns = self.build_schedule()
+
+    def build_schedule(self):
+        # Flatten the steps into (offset_ns, sound) pairs, with
+        # offsets measured from the start of the program.
+        events = []
+        offset_ns = 0
+        for step in self.steps:
+            events.append((offset_ns, step.sound))
+            offset_ns += step.duration_ns
+
+        return events, offset_ns
+
+    def render(self):
+        # Mix the whole program into one buffer, so playing it is a
+        # single hand-off to the mixer instead of one per step. Rendered
+        # on demand: keeping every program's buffer resident would take
+        # around a gigabyte with the default config.
+        return overlay([
+            (offset_ns * STREAM_FRAME_RATE // 1_000_000_000, sound.samples)
+            for offset_ns, sound in self.events
+        ])
+
+    def play(self, mixer, buffer):
         if DEBUG:
             print(f'{self.name}::start')
 
-        self.current_step_idx = 0
-        self.current_step = self.steps[0]
-        self.current_step.start()
-        self.is_running = True
+        start_ns = time.monotonic_ns()
+        mixer.play(buffer)
+        sleep_until(start_ns + self.duration_ns)
 
-    def stop(self):
         if DEBUG:
             print(f'{self.name}::stop')
 
-        self.is_running = False
-        self.current_step_idx = 0
-        self.current_step = None
-
-    @property
-    def is_complete(self):
-        return not self.is_running
-
-    def step(self):
-        self.current_step.step()
-
-        if self.current_step.is_complete:
-            self.current_step_idx += 1
-            if self.current_step_idx >= len(self.steps):
-                self.stop()
-            else:
-                self.current_step = self.steps[self.current_step_idx]
-                self.current_step.start()
-
     def __repr__(self):
         return f'Program: {self.name}'
 
 
 class Note:
+    __slots__ = ('note_name', 'octave', 'note_idx', 'identity', 'sound')
+
     NOTES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+    NOTE_IDX = {note_name: idx for idx, note_name in enumerate(NOTES)}
 
     def __init__(self, note_name, octave):
         self.note_name = note_name
         self.octave = octave
-        self.identity = Identity(note_name)
+        self.note_idx = self.NOTE_IDX[note_name]
+        self.identity = get_identity(note_name)
         self.sound = Sound(f'./samples/note/{self.name}.wav')
 
     @property
@@ -188,17 +331,8 @@ class Note:
         return f'{self.note_name}{self.octave}'
 
     def add_semitones(self, semitones):
-        idx = self.NOTES.index(self.note_name)
-
-        new_note_idx = idx + semitones
-        new_note_octave = self.octave
-        if new_note_idx >= len(self.NOTES):
-            new_note_idx -= len(self.NOTES)
-            new_note_octave += 1
-
-        new_note_name = self.NOTES[new_note_idx]
-
-        return Note(new_note_name, new_note_octave)
+        octaves, new_note_idx = divmod(self.note_idx + semitones, len(self.NOTES))
+        return get_note(self.NOTES[new_note_idx], self.octave + octaves)
 
     def add_interval(self, interval):
         return self.add_semitones(interval.semitones)
@@ -208,6 +342,8 @@ class Note:
 
 
 class Interval:
+    __slots__ = ('name', 'first_note', 'second_note', 'identity')
+
     SEMITONE_MAP = {
         'unison':  0,
         'min 2nd': 1,
@@ -228,17 +364,19 @@ class Interval:
         self.name = interval
         self.first_note = root_note
         self.second_note = root_note.add_interval(self)
-        self.identity = Identity(interval)
+        self.identity = get_identity(interval)
 
     @property
     def semitones(self):
         return self.SEMITONE_MAP[self.name]
 
-    def __repr__(slef):
-        return f'Interval: {self.name} ({self.first_name.name}/{self.second_note.name})'
+    def __repr__(self):
+        return f'Interval: {self.name} ({self.first_note.name}/{self.second_note.name})'
 
 
 class Chord:
+    __slots__ = ('chord_name', 'octave', 'inversion', 'notes', 'identity', 'sound')
+
     INTERVAL_MAP = {
         'maj': ['maj 3rd', '5th'],
         'min': ['min 3rd', '5th'],
@@ -251,13 +389,14 @@ class Chord:
         self.inversion = inversion
 
         root_note_name, chord_type = chord_name.split(' ')
-        root_note = Note(root_note_name, octave)
+        root_note = get_note(root_note_name, octave)
 
         intervals = self.INTERVAL_MAP[chord_type]
         self.notes = [root_note]
+        # Only the semitone counts are needed here, so skip building an
+        # Interval (and its identity) for each one.
         for interval_name in intervals:
-            interval = Interval(interval_name, root_note)
-            self.notes.append(root_note.add_interval(interval))
+            self.notes.append(root_note.add_semitones(Interval.SEMITONE_MAP[interval_name]))
 
         for i in range(0, inversion):
             note = self.notes.pop(0)
@@ -268,7 +407,7 @@ class Chord:
             filenames.append(f'./samples/note/{note.name}.wav')
         self.sound = Sound(filenames, sequential=False)
 
-        self.identity = Identity(chord_name)
+        self.identity = get_identity(chord_name)
 
     @property
     def name(self):
@@ -294,9 +433,9 @@ class Chord:
         # If any notes in the chord fall below the octave_range, return
         # a chord that is 1 octave lower.
         if below_range:
-            return Chord(self.chord_name, self.octave + 1, self.inversion)
+            return get_chord(self.chord_name, self.octave + 1, self.inversion)
         elif above_range:
-            return Chord(self.chord_name, self.octave - 1, self.inversion)
+            return get_chord(self.chord_name, self.octave - 1, self.inversion)
 
         return self
 
@@ -305,6 +444,8 @@ class Chord:
 
 
 class Identity:
+    __slots__ = ('name', 'sound')
+
     def __init__(self, identity):
         self.name = identity
 
@@ -321,6 +462,33 @@ class Identity:
         return f'Identity: {self.name}'
 
 
+# Notes, chords and identities are shared between programs, so each
+# distinct one is built (and its samples loaded) only once.
+_NOTE_CACHE = {}
+_CHORD_CACHE = {}
+_IDENTITY_CACHE = {}
+
+
+def get_note(note_name, octave):
+    key = (note_name, octave)
+    if key not in _NOTE_CACHE:
+        _NOTE_CACHE[key] = Note(note_name, octave)
+    return _NOTE_CACHE[key]
+
+
+def get_chord(chord_name, octave, inversion=0):
+    key = (chord_name, octave, inversion)
+    if key not in _CHORD_CACHE:
+        _CHORD_CACHE[key] = Chord(chord_name, octave, inversion)
+    return _CHORD_CACHE[key]
+
+
+def get_identity(identity):
+    if identity not in _IDENTITY_CACHE:
+        _IDENTITY_CACHE[identity] = Identity(identity)
+    return _IDENTITY_CACHE[identity]
+
+
 class ConfigFile:
     def __init__(self, filename):
         self.filename = filename
@@ -350,7 +518,7 @@ class ConfigFile:
 
         for note_name in note_programs:
             for octave in self.octave_range:
-                note = Note(note_name, octave)
+                note = get_note(note_name, octave)
                 program = Program(f'Note - {note.name}', [
                     ProgramStep_PlayNote(note, note_duration),
                     ProgramStep_PlayIdentity(note.identity, identity_duration),
@@ -369,7 +537,7 @@ class ConfigFile:
         for interval_name in interval_programs:
             for note_name in Note.NOTES:
                 for octave in self.octave_range:
-                    root_note = Note(note_name, octave)
+                    root_note = get_note(note_name, octave)
                     interval = Interval(interval_name, root_note)
                     program = Program(f'Interval - {interval.name} ({root_note.name})', [
                         ProgramStep_PlayNote(interval.first_note, note_duration),
@@ -393,7 +561,7 @@ class ConfigFile:
             for note_name in Note.NOTES:
                 chord_name = f'{note_name} {chord_type}'
                 for octave in self.octave_range:
-                    chord = Chord(chord_name, octave).limit_to_octaves(self.octave_range)
+                    chord = get_chord(chord_name, octave).limit_to_octaves(self.octave_range)
                     steps = []
                     for note in chord.notes:
                         steps.append(ProgramStep_PlayNote(note, chord_note_duration))
@@ -404,7 +572,7 @@ class ConfigFile:
 
                     if chord_inversions:
                         for i in range(1, len(chord.notes)):
-                            inverted_chord = Chord(chord_name, octave, inversion=i).limit_to_octaves(self.octave_range)
+                            inverted_chord = get_chord(chord_name, octave, inversion=i).limit_to_octaves(self.octave_range)
                             steps = []
                             for note in inverted_chord.notes:
                                 steps.append(ProgramStep_PlayNote(note, chord_note_duration))
@@ -424,22 +592,37 @@ class ProgramRunner:
         config_file = ConfigFile('./config.toml')
         self.programs = config_file.read_programs()
         self.current_program = None
+        self.queue = []
+        self.last_program = None
+        self.mixer = Mixer()
 
     def get_random_program(self):
-        idx = random.randint(0, len(self.programs)-1)
-        return self.programs[idx]
+        # Work through a shuffled copy of the programs, so each one is
+        # played once before any repeats. When a pass starts, make sure
+        # it doesn't open with the program that ended the last one.
+        if not self.queue:
+            self.queue = self.programs[:]
+            random.shuffle(self.queue)
+            if self.queue[-1] is self.last_program:
+                self.queue[-1], self.queue[0] = self.queue[0], self.queue[-1]
+        self.last_program = self.queue.pop()
+        return self.last_program
 
     def run(self):
-        while True:
-            if not self.current_program:
-                self.current_program = self.get_random_program()
-                self.current_program.start()
-                print(f'* {self.current_program.name}')
-
-            self.current_program.step()
+        # Render the next program in the background while the current
+        # one plays, so loading its samples never delays its start.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_program = self.get_random_program()
+            next_buffer = executor.submit(next_program.render)
+            while True:
+                self.current_program = next_program
+                buffer = next_buffer.result()
+
+                next_program = self.get_random_program()
+                next_buffer = executor.submit(next_program.render)
 
-            if self.current_program.is_complete:
-                self.current_program = None
+                print(f'* {self.current_program.name}')
+                self.current_program.play(self.mixer, buffer)
 
 
 if __name__ == '__main__':
@@ -1,4 +1,4 @@
-import pydub
+import soundfile as sf
 
 MARKERS = {
     'C2': 0.000,
@@ -65,11 +65,11 @@ MARKERS = {
 LENGTH = 2.0
 
 if __name__ == '__main__':
-    notes = pydub.AudioSegment.from_wav('EarTrainer_pianonotes-all.wav')
-    length_ms = LENGTH * 1000
+    notes, frame_rate = sf.read('EarTrainer_pianonotes-all.wav', dtype='int16')
+    length_frames = int(LENGTH * frame_rate)
     for note_name, offset in MARKERS.items():
-        offset_ms = offset * 1000
-        note = notes[offset_ms:offset_ms + length_ms]
+        offset_frames = int(offset * frame_rate)
+        note = notes[offset_frames:offset_frames + length_frames]
         filename = note_name.replace('#', 'sh').replace('b', 'flat')
-        note.export(f'{filename}.wav', format='wav')
+        sf.write(f'{filename}.wav', note, frame_rate, subtype='PCM_16')
     print('Done.')